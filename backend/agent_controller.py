@@ -1,50 +1,173 @@
 import asyncio
-import json
 import logging
 import os
-from pathlib import Path
-from typing import AsyncGenerator, Dict, List
+import re
+import time
+import weakref
+from collections import defaultdict
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple
 from uuid import uuid4
 
-from browser_use import Agent, Browser, ChatOpenAI, Tools, BrowserProfile, ActionResult
-from pydantic import BaseModel
+import orjson
+from browser_use import Agent, Tools, ActionResult
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, TypeAdapter
 
-from prompts import get_prompt
-from schemas import AgentRequest, BatchOrderRequest, BatchItemResult
+from browser_pool import browser_pool
+from llm import get_llm
+from semantic_cache import search_cache
+from streaming import EventQueue, drain, drain_batches, sse, ws_frame
+from prompts import get_prompt, get_extend_system_message, get_order_task
+from schemas import AgentRequest, BatchOrderRequest, BatchOrderItem
 
 logger = logging.getLogger(__name__)
 
 # --- Global State for HITL ---
-# Maps session_id -> asyncio.Future
-# When the agent needs input, it creates a future and awaits it.
-# The API /agent/input resolves this future.
-_pending_inputs: Dict[str, asyncio.Future] = {}
 
-# Reusable browser instance
-_browser = None
+class PendingInputs:
+    """
+    Maps session_id -> asyncio.Future.
+    When the agent needs input, it creates a future and awaits it.
+    The API /agent/input resolves this future.
+    Every method is synchronous, so each one runs atomically on the event loop.
+    Futures are held weakly: once nothing awaits one, its entry disappears even if
+    the session never cleaned it up.
+    """
+
+    __slots__ = ("_futures",)
+
+    def __init__(self):
+        self._futures: "weakref.WeakValueDictionary[str, asyncio.Future]" = weakref.WeakValueDictionary()
+
+    def create(self, session_id: str) -> asyncio.Future:
+        """Register a new future for session_id, cancelling any unanswered one."""
+        future = asyncio.get_running_loop().create_future()
+        previous = self._futures.get(session_id)
+        self._futures[session_id] = future
+        if previous is not None and not previous.done():
+            previous.cancel()
+        return future
+
+    def resolve(self, session_id: str, input_data: str) -> bool:
+        """Answer the pending future for session_id. Returns False if nothing was pending."""
+        future = self._futures.pop(session_id, None)
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(input_data)
+        return True
+
+    def cancel(self, session_id: str):
+        """Drop the pending future for session_id, cancelling it if unanswered."""
+        future = self._futures.pop(session_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+_pending_inputs = PendingInputs()
+
+class InflightSearches:
+    """
+    Maps (platform, normalized query) -> asyncio.Future of the product choices.
+    The first session for a query runs the agent; identical searches arriving while it
+    runs wait for its product list instead of starting another browser and agent.
+    """
+
+    def __init__(self):
+        self._futures: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    @staticmethod
+    def key(platform: str, query: str) -> Tuple[str, str]:
+        return platform, " ".join(query.lower().split())
+
+    def lead(self, key: Tuple[str, str]) -> Optional[asyncio.Future]:
+        """Return the running search for key, or register the caller as its leader and return None."""
+        future = self._futures.get(key)
+        if future is not None:
+            return future
+        self._futures[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def finish(self, key: Tuple[str, str], choices: Optional[dict]):
+        """Hand the leader's product choices (None if it found none) to every waiting session."""
+        future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(choices)
+
+_inflight_searches = InflightSearches()
+
+class OutOfStockCache:
+    """
+    Maps (product_url, color) -> time that SKU was last reported unavailable.
+    Batch items for the same SKU found unavailable within ttl seconds are failed
+    without running an agent. Other colors of the same product still run, since
+    stores mark single variants out of stock. Oldest entries are dropped past max_entries.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._expires: Dict[Tuple[str, str], float] = {}   # Insertion-ordered, oldest first
+
+    @staticmethod
+    def key(item: BatchOrderItem) -> Tuple[str, str]:
+        return item.product_url, " ".join((item.color or "").lower().split())
+
+    def __contains__(self, sku: Tuple[str, str]) -> bool:
+        expires_at = self._expires.get(sku)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._expires[sku]
+            return False
+        return True
+
+    def add(self, sku: Tuple[str, str]):
+        self._expires.pop(sku, None)
+        self._expires[sku] = time.monotonic() + self.ttl
+        if len(self._expires) > self.max_entries:
+            del self._expires[next(iter(self._expires))]
 
 MAX_STEPS = 30   # Hard limit for agent steps
 
-# Persistent browser profile directory - stores cookies, login sessions, etc.
-BROWSER_PROFILE_DIR = Path(__file__).parent / "browser_profile"
-BROWSER_PROFILE_DIR.mkdir(exist_ok=True)
-
-async def get_browser():
-    global _browser
-    # Always create a fresh browser instance for each session
-    # to avoid CDP connection issues
-    _browser = Browser(
-        browser_profile=BrowserProfile(
-            headless=os.getenv("HEADLESS", "false").lower() == "true",
-            user_data_dir=str(BROWSER_PROFILE_DIR),  # Persist cookies, login sessions
-            args=[
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-                "--disable-gpu",
-            ]
-        )
-    )
-    return _browser
+# Seconds an identical search waits for the running one before starting its own agent
+SEARCH_DEDUPE_TIMEOUT = 60
+
+# Batch items processed at once; 1 keeps batches sequential
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "1"))
+
+# Pending batch events before items wait for the client to catch up
+BATCH_QUEUE_SIZE = 256
+
+# Seconds to collect result updates into one batch_status event
+BATCH_STATUS_INTERVAL = 0.1
+
+# Seconds a batch SSE chunk waits for more events before it is written
+BATCH_FLUSH_INTERVAL = 0.02
+
+# Seconds an out-of-stock order result is reused for later items in the same batch with the same product URL and color
+OUT_OF_STOCK_TTL = float(os.getenv("OUT_OF_STOCK_TTL", "120"))
+
+# Phrases in an order result that mean the order did not go through.
+# Compiled into one alternation so a result is scanned once for all of them.
+_FAILURE_INDICATORS = (
+    "out of stock", "sold out", "unavailable", "not available",
+    "cannot be completed", "could not be placed", "cannot be placed",
+    "order failed", "unable to order", "product unavailable",
+    "currently unavailable", "no longer available"
+)
+_FAILURE_RE = re.compile("|".join(map(re.escape, _FAILURE_INDICATORS)))
+
+# Phrases that mean the product itself can't be bought, so other items for it would fail too.
+# Searched separately: failed results usually start with "ORDER FAILED", which _FAILURE_RE
+# matches first. Broader phrases like "not available" also cover payment or delivery problems.
+_OUT_OF_STOCK_INDICATORS = ("out of stock", "sold out", "currently unavailable", "no longer available")
+_OUT_OF_STOCK_RE = re.compile("|".join(map(re.escape, _OUT_OF_STOCK_INDICATORS)))
+
+# User replies to ask_user that count as a yes / no
+_AFFIRMATIVE = frozenset({'yes', 'y', 'ok', 'okay', 'sure', 'proceed', 'go ahead', 'add', 'add to cart', 'confirm'})
+_NEGATIVE = frozenset({'no', 'n', 'cancel', 'stop', 'dont', "don't", 'never mind'})
 
 # --- Pydantic Models for HITL Tools ---
 
@@ -89,298 +212,369 @@ class ShowOptionsArgs(BaseModel):
     message: str
     option_type: str = "general"  # "general", "warning", "info", "action"
 
-# --- Streaming Generator ---
+# Serializers for the option lists sent to the frontend - dump a whole list in one call
+_PRODUCTS_TA = TypeAdapter(List[ProductOption])
+_ADDRESSES_TA = TypeAdapter(List[AddressOption])
+_PAYMENTS_TA = TypeAdapter(List[PaymentOption])
+_OPTIONS_TA = TypeAdapter(List[OptionItem])
 
-async def stream_agent_events(request: AgentRequest) -> AsyncGenerator[str, None]:
-    session_id = request.session_id or str(uuid4())
-    browser = await get_browser()
+# --- HITL Tools ---
+# Shared by single sessions and batch items.
+# idx is the batch item index, or None outside of batches.
 
-    # Determine temperature based on action type
-    # - Order actions: 0.0 for fully deterministic behavior (MUST follow prompts exactly)
-    # - Search actions: slightly higher (0.2) for better product matching
-    # - User can override with custom temperature
-    if request.temperature is not None:
-        temperature = max(0.0, min(1.0, request.temperature))  # Clamp between 0 and 1
-    elif request.action == "order":
-        temperature = 0.0  # Fully deterministic - MUST follow prompts exactly
-    else:
-        temperature = 0.2  # Slightly more flexible for search
+def _log_prefix(idx: Optional[int]) -> str:
+    return f"[Batch Item {idx}] " if idx is not None else ""
 
-    # Initialize LLM with temperature
-    llm = ChatOpenAI(model="gpt-4o", temperature=temperature)
-
-    logger.info(f"Starting agent with temperature={temperature} for action={request.action}")
+async def _wait_for_input(event: dict, session_id: str, event_queue: EventQueue, idx: Optional[int]) -> str:
+    """Send a HITL event to the frontend and wait for /agent/input to answer it."""
+    future = _pending_inputs.create(session_id)
 
-    # Validate order action has product_url
-    if request.action == "order" and not request.product_url:
-        yield f"data: {json.dumps({'type': 'error', 'content': 'Product URL required for order action'})}\n\n"
-        return
+    event["session_id"] = session_id
+    if idx is not None:
+        event["batch_item_index"] = idx
+    event_queue.put_nowait(event)
 
-    # Get the appropriate task and extend_system_message
-    try:
-        prompt_config = get_prompt(
-            platform=request.platform,
-            action=request.action,
-            product_url=request.product_url,
-            query=request.user_message if request.action == "search" else None,
-            additional_instructions=request.user_message if request.action == "order" else None,
-            quantity=request.quantity if request.action == "order" else 1,
-            color=request.color if request.action == "order" else None
-        )
-        task = prompt_config["task"]
-        extend_system_message = prompt_config["extend_system_message"]
-    except ValueError as e:
-        yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
-        return
+    return await future
 
-    # Send initial config info to frontend
-    yield f"data: {json.dumps({'type': 'config', 'content': {'temperature': temperature, 'action': request.action, 'platform': request.platform}})}\n\n"
+async def ask_user_tool(params: AskUserArgs, session_id: str, event_queue: EventQueue, idx: Optional[int] = None) -> ActionResult:
+    question = params.question
+    logger.info(f"{_log_prefix(idx)}Asking user: {question}")
 
-    # --- Dynamic Tools with Closure for Session ID ---
-    # Create Tools instance for this session to capture session_id in closures
-    local_tools = Tools()
+    result = await _wait_for_input({
+        "type": "request_input",
+        "content": question
+    }, session_id, event_queue, idx)
+    user_response = result.strip().lower()
 
-    @local_tools.action(
-        "Ask the user for information or confirmation. Use this for OTP, Login credentials, cart confirmation, or any human input.",
-        param_model=AskUserArgs
-    )
-    async def ask_user_tool(params: AskUserArgs) -> ActionResult:
-        question = params.question
-        logger.info(f"Asking user: {question}")
+    # Check for affirmative responses
+    if user_response in _AFFIRMATIVE:
+        return ActionResult(
+            extracted_content=f"USER CONFIRMED: '{result}'. Proceed with the action. Do NOT ask again."
+        )
+    # Check for negative responses
+    elif user_response in _NEGATIVE:
+        return ActionResult(
+            extracted_content=f"USER DECLINED: '{result}'. Do NOT proceed. Inform user you cancelled."
+        )
+    else:
+        # For other inputs (OTP, phone number, password)
+        return ActionResult(
+            extracted_content=f"USER PROVIDED: '{result}'. Use this value. Do NOT ask again."
+        )
 
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        _pending_inputs[session_id] = future
+async def show_product_choices(params: ShowProductChoicesArgs, session_id: str, event_queue: EventQueue, idx: Optional[int] = None,
+                               on_choices: Optional[Callable[[dict], None]] = None) -> ActionResult:
+    logger.info(f"{_log_prefix(idx)}Showing {len(params.products)} product choices to user")
 
-        event_queue.put_nowait({
-            "type": "request_input",
-            "content": question,
-            "session_id": session_id
-        })
+    choices = {
+        "message": params.message,
+        "products": _PRODUCTS_TA.dump_python(params.products)
+    }
+    if on_choices:
+        on_choices(choices)
 
-        result = await future
-        user_response = result.strip().lower()
+    result = await _wait_for_input({
+        "type": "product_choices",
+        "content": choices
+    }, session_id, event_queue, idx)
 
-        # Check for affirmative responses
-        if user_response in ['yes', 'y', 'ok', 'okay', 'sure', 'proceed', 'go ahead', 'add', 'add to cart', 'confirm']:
-            return ActionResult(
-                extracted_content=f"USER CONFIRMED: '{result}'. Proceed with the action. Do NOT ask again."
-            )
-        # Check for negative responses
-        elif user_response in ['no', 'n', 'cancel', 'stop', 'dont', "don't", 'never mind']:
-            return ActionResult(
-                extracted_content=f"USER DECLINED: '{result}'. Do NOT proceed. Inform user you cancelled."
-            )
-        else:
-            # For other inputs (OTP, phone number, password)
+    try:
+        selected_idx = int(result)
+        if 0 <= selected_idx < len(params.products):
+            selected = params.products[selected_idx]
+            product_json = orjson.dumps({
+                "product_name": selected.product_name,
+                "price": selected.price,
+                "rating": selected.rating,
+                "product_url": selected.product_url
+            }).decode()
+            # is_done=True terminates the agent with this result
             return ActionResult(
-                extracted_content=f"USER PROVIDED: '{result}'. Use this value. Do NOT ask again."
+                extracted_content=product_json,
+                is_done=True,
+                success=True
             )
+    except (ValueError, IndexError):
+        pass
 
-    @local_tools.action(
-        "Show product options to user and get their choice. Terminates the task with selected product.",
-        param_model=ShowProductChoicesArgs
-    )
-    async def show_product_choices(params: ShowProductChoicesArgs) -> ActionResult:
-        logger.info(f"Showing {len(params.products)} product choices to user")
+    return ActionResult(extracted_content=f"User response: {result}")
 
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        _pending_inputs[session_id] = future
+async def show_address_choices(params: ShowAddressChoicesArgs, session_id: str, event_queue: EventQueue, idx: Optional[int] = None) -> ActionResult:
+    logger.info(f"{_log_prefix(idx)}Showing {len(params.addresses)} address choices to user")
 
-        event_queue.put_nowait({
-            "type": "product_choices",
-            "content": {
-                "message": params.message,
-                "products": [p.model_dump() for p in params.products]
-            },
-            "session_id": session_id
-        })
+    result = await _wait_for_input({
+        "type": "address_choices",
+        "content": {
+            "message": params.message,
+            "addresses": _ADDRESSES_TA.dump_python(params.addresses)
+        }
+    }, session_id, event_queue, idx)
 
-        result = await future
+    try:
+        selected_idx = int(result)
+        if 0 <= selected_idx < len(params.addresses):
+            selected = params.addresses[selected_idx]
 
-        try:
-            selected_idx = int(result)
-            if 0 <= selected_idx < len(params.products):
-                selected = params.products[selected_idx]
-                product_json = json.dumps({
-                    "product_name": selected.product_name,
-                    "price": selected.price,
-                    "rating": selected.rating,
-                    "product_url": selected.product_url
-                })
-                # is_done=True terminates the agent with this result
+            if selected.address_type == "NEW" or "Add New Address" in selected.name:
                 return ActionResult(
-                    extracted_content=product_json,
-                    is_done=True,
-                    success=True
+                    extracted_content="USER WANTS NEW ADDRESS. Click '+ Add a new address', then ask for: Full Name, Phone, Pincode, Address, City, State."
                 )
-        except (ValueError, IndexError):
-            pass
 
-        return ActionResult(extracted_content=f"User response: {result}")
+            return ActionResult(
+                extracted_content=f"USER SELECTED ADDRESS #{selected_idx + 1}: {selected.name}, {selected.address}. ACTION REQUIRED: Check if this address already has 'Deliver Here' button visible. If YES → click 'Deliver Here' directly. If NO → first click the RADIO BUTTON next to this address, wait 2 seconds for 'Deliver Here' to appear, then click it."
+            )
+    except (ValueError, IndexError):
+        pass
+
+    return ActionResult(extracted_content=f"User response: {result}")
 
-    @local_tools.action(
-        "MANDATORY: Show delivery address options to user. You MUST call this when you see address/delivery page. NEVER click 'Deliver Here' without calling this first.",
-        param_model=ShowAddressChoicesArgs
-    )
-    async def show_address_choices(params: ShowAddressChoicesArgs) -> ActionResult:
-        logger.info(f"Showing {len(params.addresses)} address choices to user")
+async def show_payment_choices(params: ShowPaymentChoicesArgs, session_id: str, event_queue: EventQueue, idx: Optional[int] = None) -> ActionResult:
+    logger.info(f"{_log_prefix(idx)}Showing {len(params.payments)} payment choices to user")
 
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        _pending_inputs[session_id] = future
+    result = await _wait_for_input({
+        "type": "payment_choices",
+        "content": {
+            "message": params.message,
+            "payments": _PAYMENTS_TA.dump_python(params.payments)
+        }
+    }, session_id, event_queue, idx)
 
-        event_queue.put_nowait({
-            "type": "address_choices",
-            "content": {
-                "message": params.message,
-                "addresses": [a.model_dump() for a in params.addresses]
-            },
-            "session_id": session_id
-        })
+    try:
+        selected_idx = int(result)
+        if 0 <= selected_idx < len(params.payments):
+            selected = params.payments[selected_idx]
+            return ActionResult(
+                extracted_content=f"USER SELECTED PAYMENT: {selected.method}. Click this payment option on the page."
+            )
+    except (ValueError, IndexError):
+        pass
 
-        result = await future
+    return ActionResult(extracted_content=f"User response: {result}")
 
-        try:
-            selected_idx = int(result)
-            if 0 <= selected_idx < len(params.addresses):
-                selected = params.addresses[selected_idx]
+async def show_options(params: ShowOptionsArgs, session_id: str, event_queue: EventQueue, idx: Optional[int] = None) -> ActionResult:
+    logger.info(f"{_log_prefix(idx)}Showing {len(params.options)} options to user: {params.message}")
 
-                if selected.address_type == "NEW" or "Add New Address" in selected.name:
-                    return ActionResult(
-                        extracted_content="USER WANTS NEW ADDRESS. Click '+ Add a new address', then ask for: Full Name, Phone, Pincode, Address, City, State."
-                    )
+    result = await _wait_for_input({
+        "type": "options",
+        "content": {
+            "message": params.message,
+            "options": _OPTIONS_TA.dump_python(params.options),
+            "option_type": params.option_type
+        }
+    }, session_id, event_queue, idx)
 
-                return ActionResult(
-                    extracted_content=f"USER SELECTED ADDRESS #{selected_idx + 1}: {selected.name}, {selected.address}. ACTION REQUIRED: Check if this address already has 'Deliver Here' button visible. If YES → click 'Deliver Here' directly. If NO → first click the RADIO BUTTON next to this address, wait 2 seconds for 'Deliver Here' to appear, then click it."
-                )
-        except (ValueError, IndexError):
-            pass
+    try:
+        selected_idx = int(result)
+        if 0 <= selected_idx < len(params.options):
+            selected = params.options[selected_idx]
+            value = selected.value if selected.value else selected.label
+            return ActionResult(
+                extracted_content=f"USER SELECTED: {selected.label} (value: {value}). Proceed with this selection."
+            )
+    except (ValueError, IndexError):
+        pass
+
+    return ActionResult(extracted_content=f"User response: {result}")
+
+def build_tools(session_id: str, event_queue: EventQueue, idx: Optional[int] = None,
+                on_product_choices: Optional[Callable[[dict], None]] = None) -> Tools:
+    """
+    Create the Tools for one agent session, with the HITL actions bound to its
+    session_id, event queue and batch item index.
+    on_product_choices is called with every product list shown to the user.
+    """
+    tools = Tools()
 
-        return ActionResult(extracted_content=f"User response: {result}")
+    def register(description: str, param_model: type, handler: Callable, **extra):
+        async def action(params):
+            return await handler(params, session_id, event_queue, idx, **extra)
+        # browser_use registers actions under the function name
+        action.__name__ = action.__qualname__ = handler.__name__
+        tools.action(description, param_model=param_model)(action)
 
-    @local_tools.action(
+    register(
+        "Ask the user for information or confirmation. Use this for OTP, Login credentials, cart confirmation, or any human input.",
+        AskUserArgs, ask_user_tool
+    )
+    # Batch items are orders only - no product search
+    if idx is None:
+        register(
+            "Show product options to user and get their choice. Terminates the task with selected product.",
+            ShowProductChoicesArgs, show_product_choices, on_choices=on_product_choices
+        )
+    register(
+        "MANDATORY: Show delivery address options to user. You MUST call this when you see address/delivery page. NEVER click 'Deliver Here' without calling this first.",
+        ShowAddressChoicesArgs, show_address_choices
+    )
+    register(
         "MANDATORY: Show payment method options to user. You MUST call this when you see payment page. NEVER select a payment method without calling this first.",
-        param_model=ShowPaymentChoicesArgs
+        ShowPaymentChoicesArgs, show_payment_choices
+    )
+    register(
+        "MANDATORY: Show quantity/variant options to user. You MUST call this when you see quantity selector or product variants. NEVER select quantity without calling this first.",
+        ShowOptionsArgs, show_options
     )
-    async def show_payment_choices(params: ShowPaymentChoicesArgs) -> ActionResult:
-        logger.info(f"Showing {len(params.payments)} payment choices to user")
+    return tools
 
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        _pending_inputs[session_id] = future
+def _emit_step_log(event_queue: EventQueue, prefix: str, step: int, output) -> None:
+    """Queue the agent's thinking for this step as a log event."""
+    try:
+        thought = output.current_state.thinking if output and output.current_state else "Processing..."
+    except Exception as e:
+        logger.warning(f"Error in step_callback: {e}")
+        thought = "Processing..."
+    event_queue.put_nowait({
+        "type": "log",
+        "content": f"{prefix}Step {step}/{MAX_STEPS}: {thought}"
+    })
 
-        event_queue.put_nowait({
-            "type": "payment_choices",
-            "content": {
-                "message": params.message,
-                "payments": [p.model_dump() for p in params.payments]
-            },
-            "session_id": session_id
-        })
+# --- Streaming Generator ---
 
-        result = await future
+async def agent_events(request: AgentRequest) -> AsyncGenerator[List[dict], None]:
+    """
+    Run one agent session and yield its events in bursts.
+    Transport-agnostic: stream_agent_events frames them as SSE, stream_agent_websocket as WebSocket messages.
+    """
+    session_id = request.session_id or str(uuid4())
 
-        try:
-            selected_idx = int(result)
-            if 0 <= selected_idx < len(params.payments):
-                selected = params.payments[selected_idx]
-                return ActionResult(
-                    extracted_content=f"USER SELECTED PAYMENT: {selected.method}. Click this payment option on the page."
-                )
-        except (ValueError, IndexError):
-            pass
+    # Determine temperature based on action type
+    # - Order actions: 0.0 for fully deterministic behavior (MUST follow prompts exactly)
+    # - Search actions: slightly higher (0.2) for better product matching
+    # - User can override with custom temperature
+    if request.temperature is not None:
+        temperature = max(0.0, min(1.0, request.temperature))  # Clamp between 0 and 1
+    elif request.action == "order":
+        temperature = 0.0  # Fully deterministic - MUST follow prompts exactly
+    else:
+        temperature = 0.2  # Slightly more flexible for search
 
-        return ActionResult(extracted_content=f"User response: {result}")
+    # Initialize LLM with temperature
+    # extend_system_message only depends on platform/action and is sent before the task,
+    # so sessions with the same platform/action share a cached prompt prefix
+    llm = get_llm(temperature, cache_key=f"{request.platform}:{request.action}")
 
-    @local_tools.action(
-        "MANDATORY: Show quantity/variant options to user. You MUST call this when you see quantity selector or product variants. NEVER select quantity without calling this first.",
-        param_model=ShowOptionsArgs
-    )
-    async def show_options(params: ShowOptionsArgs) -> ActionResult:
-        logger.info(f"Showing {len(params.options)} options to user: {params.message}")
+    logger.info(f"Starting agent with temperature={temperature} for action={request.action}")
 
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        _pending_inputs[session_id] = future
+    # Validate order action has product_url
+    if request.action == "order" and not request.product_url:
+        yield [{'type': 'error', 'content': 'Product URL required for order action'}]
+        return
 
-        event_queue.put_nowait({
-            "type": "options",
-            "content": {
-                "message": params.message,
-                "options": [o.model_dump() for o in params.options],
-                "option_type": params.option_type
-            },
-            "session_id": session_id
-        })
+    # Get the appropriate task and extend_system_message
+    try:
+        prompt_config = get_prompt(
+            platform=request.platform,
+            action=request.action,
+            product_url=request.product_url,
+            query=request.user_message if request.action == "search" else None,
+            additional_instructions=request.user_message if request.action == "order" else None,
+            quantity=request.quantity if request.action == "order" else 1,
+            color=request.color if request.action == "order" else None
+        )
+        task = prompt_config["task"]
+        extend_system_message = prompt_config["extend_system_message"]
+    except ValueError as e:
+        yield [{'type': 'error', 'content': str(e)}]
+        return
 
-        result = await future
+    # Send initial config info to frontend
+    yield [{'type': 'config', 'content': {'temperature': temperature, 'action': request.action, 'platform': request.platform}}]
+
+    # Serve near-identical searches from the semantic cache without running an agent,
+    # and let identical searches that are already running share one agent.
+    # Orders are never cached - they have side effects.
+    query_embedding = None
+    search_key = None  # Set while this session leads an in-flight search
+    if request.action == "search":
+        key = InflightSearches.key(request.platform, request.user_message)
+        running = _inflight_searches.lead(key)
+        if running is not None:
+            yield [{'type': 'log', 'content': 'Same search already in progress, waiting for its results...'}]
+            try:
+                cached_choices = await asyncio.wait_for(asyncio.shield(running), SEARCH_DEDUPE_TIMEOUT)
+            except TimeoutError:
+                # Leader is taking too long: run this session's own agent instead
+                yield [{'type': 'log', 'content': 'Search in progress is taking too long, starting a new one...'}]
+                cached_choices = None
+        else:
+            search_key = key
+            try:
+                query_embedding = await search_cache.embed(request.user_message)
+            except BaseException:
+                _inflight_searches.finish(search_key, None)
+                raise
+            cached_choices = search_cache.lookup(request.platform, query_embedding)
+            if cached_choices is not None:
+                _inflight_searches.finish(search_key, cached_choices)
+                search_key = None
+        if cached_choices is not None:
+            future = _pending_inputs.create(session_id)
+            yield [{'type': 'product_choices', 'content': cached_choices, 'session_id': session_id}]
+            try:
+                result = await future
+            finally:
+                _pending_inputs.cancel(session_id)
+            try:
+                selected_idx = int(result)
+                if 0 <= selected_idx < len(cached_choices["products"]):
+                    yield [{'type': 'result', 'content': orjson.dumps(cached_choices['products'][selected_idx]).decode()}]
+                    return
+            except ValueError:
+                pass
+            # Anything other than a product pick: run the agent as usual
 
-        try:
-            selected_idx = int(result)
-            if 0 <= selected_idx < len(params.options):
-                selected = params.options[selected_idx]
-                value = selected.value if selected.value else selected.label
-                return ActionResult(
-                    extracted_content=f"USER SELECTED: {selected.label} (value: {value}). Proceed with this selection."
-                )
-        except (ValueError, IndexError):
-            pass
+    # Event Queue for streaming
+    event_queue = EventQueue()
 
-        return ActionResult(extracted_content=f"User response: {result}")
+    def on_product_choices(choices):
+        search_cache.store(request.platform, query_embedding, choices)
+        if search_key is not None:
+            _inflight_searches.finish(search_key, choices)
 
-    # Event Queue for streaming
-    event_queue = asyncio.Queue()
+    # Tools for this session - HITL actions bound to session_id and event_queue
+    local_tools = build_tools(session_id, event_queue, on_product_choices=on_product_choices)
 
     # Step counter for limit enforcement
     step_counter = 0
 
-    # Step Callback with step limit logic
-    async def step_callback(state, output, step_idx):
+    # Step Callback with step limit logic.
+    # Plain function: browser_use calls sync callbacks directly, so each step skips a coroutine.
+    def step_callback(state, output, step_idx):
         nonlocal step_counter
         step_counter += 1
 
         # Check if max steps reached and force stop
         if step_counter >= MAX_STEPS:
             logger.warning(f"Max steps ({MAX_STEPS}) reached. Forcing stop.")
-            await agent.stop(
-                f"STOPPED: Maximum step limit ({MAX_STEPS}) reached. Task terminated."
-            )
+            agent.stop()
             return
 
         # This runs every step
         # expected_output is AgentOutput, looking into it for thoughts/logs.
-        try:
-            thought = output.current_state.thinking if output and output.current_state else "Processing..."
-            event_queue.put_nowait({
-                "type": "log",
-                "content": f"Step {step_counter}/{MAX_STEPS}: {thought}"
-            })
-        except Exception as e:
-            logger.warning(f"Error in step_callback: {e}")
-            event_queue.put_nowait({
-                "type": "log",
-                "content": f"Step {step_counter}/{MAX_STEPS}: Processing..."
-            })
+        _emit_step_log(event_queue, "", step_counter, output)
 
-    agent = Agent(
-        task=task,
-        llm=llm,
-        browser=browser,
-        tools=local_tools,
-        extend_system_message=extend_system_message,
-        register_new_step_callback=step_callback,
-        max_steps=MAX_STEPS,
-        max_failures=3,
-        max_actions_per_step=4,
-        calculate_cost=True,  # Enable token/cost tracking
-    )
+    # Assigned in run_agent_task once a browser is free; step_callback uses it to stop the agent
+    agent = None
 
     # Run agent in background task so we can consume the queue
     async def run_agent_task():
+        nonlocal agent
         try:
-            history = await agent.run()
+            # Take a browser from the pool for this session; it is returned when the agent finishes
+            async with browser_pool.acquire() as browser:
+                agent = Agent(
+                    task=task,
+                    llm=llm,
+                    browser=browser,
+                    tools=local_tools,
+                    extend_system_message=extend_system_message,
+                    register_new_step_callback=step_callback,
+                    max_steps=MAX_STEPS,
+                    max_failures=3,
+                    max_actions_per_step=4,
+                    calculate_cost=True,  # Enable token/cost tracking
+                )
+                history = await agent.run()
             result = history.final_result()
 
             # Send result
@@ -428,387 +622,335 @@ async def stream_agent_events(request: AgentRequest) -> AsyncGenerator[str, None
             })
         finally:
             # Clean up any pending input futures for this session
-            if session_id in _pending_inputs:
-                future = _pending_inputs.pop(session_id)
-                if not future.done():
-                    future.cancel()
+            _pending_inputs.cancel(session_id)
+            # Release sessions waiting on this search if the agent never showed products
+            if search_key is not None:
+                _inflight_searches.finish(search_key, None)
             event_queue.put_nowait(None) # Sentinel
 
     # Start the agent
-    asyncio.create_task(run_agent_task())
+    agent_task = asyncio.create_task(run_agent_task())
+
+    try:
+        # Yield from queue
+        async for batch in drain_batches(event_queue):
+            yield batch
+        await agent_task
+    finally:
+        # Client went away mid-session: stop the agent so its browser goes back to the pool
+        if not agent_task.done():
+            agent_task.cancel()
+
+async def stream_agent_events(request: AgentRequest) -> AsyncGenerator[bytes, None]:
+    async with aclosing(agent_events(request)) as events:
+        async for batch in events:
+            yield b"".join(map(sse, batch))
+
+async def stream_agent_websocket(request: AgentRequest, websocket: WebSocket):
+    """
+    Run an agent session over an accepted WebSocket.
+    Events are sent as JSON arrays, one message per burst. HITL answers come back over
+    the same socket as {"type": "input", "data": ...} instead of a POST to /agent/input.
+    """
+    if not request.session_id:
+        request.session_id = str(uuid4())
+    session_id = request.session_id
+
+    async def send_events():
+        async with aclosing(agent_events(request)) as events:
+            async for batch in events:
+                await websocket.send_bytes(ws_frame(batch))
+
+    sender = asyncio.create_task(send_events())
+
+    async def receive_inputs():
+        try:
+            while True:
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    break
+                # Text or binary frames are accepted; anything that isn't JSON is skipped
+                try:
+                    message = orjson.loads(frame.get("text") or frame.get("bytes") or b"")
+                except orjson.JSONDecodeError:
+                    logger.warning("Ignoring malformed WebSocket frame for session %s", session_id)
+                    continue
+                if isinstance(message, dict) and message.get("type") == "input":
+                    data = message.get("data")
+                    _pending_inputs.resolve(session_id, data if isinstance(data, str) else orjson.dumps(data).decode())
+        finally:
+            # Whatever ended the receiver (usually the client leaving), stop the agent now
+            # rather than when the next send fails
+            sender.cancel()
+
+    receiver = asyncio.create_task(receive_inputs())
+    try:
+        await sender
+    except WebSocketDisconnect:
+        logger.info("WebSocket for session %s disconnected", session_id)
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise  # The endpoint itself is being cancelled
+        logger.info("WebSocket for session %s disconnected", session_id)
+    finally:
+        sender.cancel()
+        receiver.cancel()
 
-    # Yield from queue
-    while True:
-        event = await event_queue.get()
-        if event is None:
-            break
-        yield f"data: {json.dumps(event)}\n\n"
 
 async def provide_input(session_id: str, input_data: str):
-    if session_id in _pending_inputs:
-        future = _pending_inputs[session_id]
-        if not future.done():
-            future.set_result(input_data)
-        del _pending_inputs[session_id]
+    if _pending_inputs.resolve(session_id, input_data):
         return {"status": "success"}
     return {"status": "error", "message": "No pending input for this session"}
 
 
 # --- Batch Order Processing ---
 
-async def stream_batch_order_events(request: BatchOrderRequest) -> AsyncGenerator[str, None]:
+@dataclass(slots=True)
+class BatchUsage:
+    """Token/cost totals across a batch. orjson encodes it as-is for batch_usage events."""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+    total_cost: float = 0.0
+    total_steps: int = 0
+
+async def stream_batch_order_events(request: BatchOrderRequest) -> AsyncGenerator[bytes, None]:
     """
-    Process multiple orders in sequence.
-    Uses a SINGLE browser instance for all items (more efficient).
-    Browser stays open until ALL items are processed.
+    Process multiple orders.
+    Each item takes a browser from the pool and keeps it until its agent finishes.
+    Items run sequentially unless request.max_concurrency (or BATCH_CONCURRENCY) > 1,
+    in which case up to that many items (capped by the pool size) run at once, each in its own browser.
+    All items stream their events into one queue.
     """
     batch_session_id = request.session_id or str(uuid4())
-
-    # Results tracking
-    results: List[BatchItemResult] = []
-    for idx, item in enumerate(request.items):
-        results.append(BatchItemResult(
-            index=idx,
-            product_url=item.product_url,
-            quantity=item.quantity,
-            color=item.color,
-            status="pending"
-        ))
+    total_items = len(request.items)
+
+    # Results tracking - one JSON-ready row per item, shaped like schemas.BatchItemResult.
+    # Plain dicts: updates and batch_status frames skip pydantic validation and model_dump.
+    results: List[dict] = [
+        {
+            "index": idx,
+            "product_url": item.product_url,
+            "quantity": item.quantity,
+            "color": item.color,
+            "status": "pending",
+            "message": None,
+            "error": None,
+        }
+        for idx, item in enumerate(request.items)
+    ]
 
     # Initialize batch config
     temperature = request.temperature if request.temperature is not None else 0.0
-    llm = ChatOpenAI(model="gpt-4o", temperature=temperature)
+    # One LLM client for every item, pinned to the batch session so items 2..N hit the cached system prompt
+    llm = get_llm(temperature, cache_key=batch_session_id)
+
+    # The system prompt only depends on the platform - build it once for the whole batch
+    extend_system_message = get_extend_system_message(request.platform, "order")
 
     # Send initial batch config
-    yield f"data: {json.dumps({'type': 'batch_start', 'content': {'total_items': len(request.items), 'platform': request.platform, 'session_id': batch_session_id}})}\n\n"
+    yield sse({'type': 'batch_start', 'content': {'total_items': total_items, 'platform': request.platform, 'session_id': batch_session_id}})
 
     # Send initial results state
-    yield f"data: {json.dumps({'type': 'batch_status', 'content': [r.model_dump() for r in results]})}\n\n"
-
-    yield f"data: {json.dumps({'type': 'log', 'content': f'Starting batch processing of {len(request.items)} items'})}\n\n"
-
-    # Create a SINGLE browser instance for ALL items
-    # keep_alive=True prevents browser reset between agent runs
-    # user_data_dir persists cookies and login sessions
-    browser = Browser(
-        browser_profile=BrowserProfile(
-            headless=os.getenv("HEADLESS", "false").lower() == "true",
-            keep_alive=True,  # Prevents browser from being reset after each agent completes
-            user_data_dir=str(BROWSER_PROFILE_DIR),  # Persist cookies, login sessions
-            args=[
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-                "--disable-gpu",
-            ]
-        )
-    )
+    yield sse({'type': 'batch_status', 'content': results})
 
-    yield f"data: {json.dumps({'type': 'log', 'content': 'Browser opened - will remain open for all items'})}\n\n"
+    yield sse({'type': 'log', 'content': f'Starting batch processing of {total_items} items'})
 
     # Track total usage across all batch items
-    total_batch_usage = {
-        "input_tokens": 0,
-        "output_tokens": 0,
-        "total_tokens": 0,
-        "total_cost": 0,
-        "total_steps": 0
-    }
-
-    try:
-        # Process each item sequentially using the SAME browser
-        for idx, item in enumerate(request.items):
-            item_session_id = f"{batch_session_id}_item_{idx}"
-
+    total_batch_usage = BatchUsage()
+
+    # Event Queue shared by all items. Bounded, so items wait for a slow client
+    # instead of piling up events
+    event_queue = EventQueue(maxsize=BATCH_QUEUE_SIZE)
+    # Bound once - items call it for every status, log and usage event
+    put_event = event_queue.put
+
+    # Progress logs (agent steps, item started/succeeded) only in verbose mode.
+    # Failures, status deltas and usage are always sent.
+    verbose = request.log_level == "verbose"
+
+    # Result updates within BATCH_STATUS_INTERVAL share one batch_status_delta event
+    # carrying only the rows that changed; the client patches them in by index
+    loop = asyncio.get_running_loop()
+    status_flush: Optional[asyncio.TimerHandle] = None
+    changed: set = set()
+
+    def flush_status():
+        nonlocal status_flush
+        status_flush = None
+        event_queue.put_nowait({'type': 'batch_status_delta', 'content': [results[i] for i in sorted(changed)]})
+        changed.clear()
+
+    def update_result(idx: int, **fields):
+        nonlocal status_flush
+        results[idx].update(fields)
+        changed.add(idx)
+        if status_flush is None:
+            status_flush = loop.call_later(BATCH_STATUS_INTERVAL, flush_status)
+
+    # Each running item holds a pooled browser, so never run more items than the pool can hold
+    concurrency = max(1, min(request.max_concurrency or BATCH_CONCURRENCY, browser_pool.max_size))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(idx: int, item: BatchOrderItem):
+        item_session_id = f"{batch_session_id}_item_{idx}"
+
+        # Step counter and callback
+        step_counter = 0
+        agent = None
+
+        def step_callback(state, output, step_idx):
+            nonlocal step_counter
+            step_counter += 1
+
+            if step_counter >= MAX_STEPS:
+                logger.warning("[Batch Item %d] Max steps (%d) reached.", idx, MAX_STEPS)
+                agent.stop()
+                return
+
+            if verbose:
+                _emit_step_log(event_queue, f"[Item {idx + 1}] ", step_counter, output)
+
+        async with semaphore:
             # Update status to in_progress
-            results[idx].status = "in_progress"
-            yield f"data: {json.dumps({'type': 'batch_status', 'content': [r.model_dump() for r in results]})}\n\n"
-            yield f"data: {json.dumps({'type': 'log', 'content': f'Starting item {idx + 1}/{len(request.items)}: {item.product_url}'})}\n\n"
+            update_result(idx, status="in_progress")
+            if verbose:
+                await put_event({'type': 'log', 'content': f'Starting item {idx + 1}/{total_items}: {item.product_url}'})
 
             try:
-                # Get prompt for this item
-                prompt_config = get_prompt(
+                # Get task for this item
+                task = get_order_task(
                     platform=request.platform,
-                    action="order",
                     product_url=item.product_url,
                     additional_instructions=request.additional_instructions,
                     quantity=item.quantity,
                     color=item.color
                 )
-                task = prompt_config["task"]
-                extend_system_message = prompt_config["extend_system_message"]
 
                 # Create tools for this item's session
-                local_tools = Tools()
-                event_queue = asyncio.Queue()
-
-                # Capture idx and item_session_id in closures
-                current_idx = idx
-                current_session_id = item_session_id
-
-                @local_tools.action(
-                    "Ask the user for information or confirmation. Use this for OTP, Login credentials, cart confirmation, or any human input.",
-                    param_model=AskUserArgs
-                )
-                async def ask_user_tool(params: AskUserArgs, _idx=current_idx, _sid=current_session_id) -> ActionResult:
-                    question = params.question
-                    logger.info(f"[Batch Item {_idx}] Asking user: {question}")
-
-                    loop = asyncio.get_running_loop()
-                    future = loop.create_future()
-                    _pending_inputs[_sid] = future
-
-                    event_queue.put_nowait({
-                        "type": "request_input",
-                        "content": question,
-                        "session_id": _sid,
-                        "batch_item_index": _idx
-                    })
-
-                    result = await future
-                    user_response = result.strip().lower()
-
-                    if user_response in ['yes', 'y', 'ok', 'okay', 'sure', 'proceed', 'go ahead', 'add', 'add to cart', 'confirm']:
-                        return ActionResult(extracted_content=f"USER CONFIRMED: '{result}'. Proceed with the action. Do NOT ask again.")
-                    elif user_response in ['no', 'n', 'cancel', 'stop', 'dont', "don't", 'never mind']:
-                        return ActionResult(extracted_content=f"USER DECLINED: '{result}'. Do NOT proceed. Inform user you cancelled.")
-                    else:
-                        return ActionResult(extracted_content=f"USER PROVIDED: '{result}'. Use this value. Do NOT ask again.")
-
-                @local_tools.action(
-                    "MANDATORY: Show delivery address options to user.",
-                    param_model=ShowAddressChoicesArgs
-                )
-                async def show_address_choices(params: ShowAddressChoicesArgs, _idx=current_idx, _sid=current_session_id) -> ActionResult:
-                    logger.info(f"[Batch Item {_idx}] Showing {len(params.addresses)} address choices")
-
-                    loop = asyncio.get_running_loop()
-                    future = loop.create_future()
-                    _pending_inputs[_sid] = future
-
-                    event_queue.put_nowait({
-                        "type": "address_choices",
-                        "content": {"message": params.message, "addresses": [a.model_dump() for a in params.addresses]},
-                        "session_id": _sid,
-                        "batch_item_index": _idx
-                    })
-
-                    result = await future
-                    try:
-                        selected_idx = int(result)
-                        if 0 <= selected_idx < len(params.addresses):
-                            selected = params.addresses[selected_idx]
-                            if selected.address_type == "NEW" or "Add New Address" in selected.name:
-                                return ActionResult(extracted_content="USER WANTS NEW ADDRESS. Click '+ Add a new address', then ask for: Full Name, Phone, Pincode, Address, City, State.")
-                            return ActionResult(extracted_content=f"USER SELECTED ADDRESS #{selected_idx + 1}: {selected.name}, {selected.address}. Click 'DELIVER HERE' for this address.")
-                    except (ValueError, IndexError):
-                        pass
-                    return ActionResult(extracted_content=f"User response: {result}")
-
-                @local_tools.action(
-                    "MANDATORY: Show payment method options to user.",
-                    param_model=ShowPaymentChoicesArgs
-                )
-                async def show_payment_choices(params: ShowPaymentChoicesArgs, _idx=current_idx, _sid=current_session_id) -> ActionResult:
-                    logger.info(f"[Batch Item {_idx}] Showing {len(params.payments)} payment choices")
-
-                    loop = asyncio.get_running_loop()
-                    future = loop.create_future()
-                    _pending_inputs[_sid] = future
-
-                    event_queue.put_nowait({
-                        "type": "payment_choices",
-                        "content": {"message": params.message, "payments": [p.model_dump() for p in params.payments]},
-                        "session_id": _sid,
-                        "batch_item_index": _idx
-                    })
-
-                    result = await future
-                    try:
-                        selected_idx = int(result)
-                        if 0 <= selected_idx < len(params.payments):
-                            selected = params.payments[selected_idx]
-                            return ActionResult(extracted_content=f"USER SELECTED PAYMENT: {selected.method}. Click this payment option on the page.")
-                    except (ValueError, IndexError):
-                        pass
-                    return ActionResult(extracted_content=f"User response: {result}")
-
-                @local_tools.action(
-                    "MANDATORY: Show options to user.",
-                    param_model=ShowOptionsArgs
-                )
-                async def show_options(params: ShowOptionsArgs, _idx=current_idx, _sid=current_session_id) -> ActionResult:
-                    logger.info(f"[Batch Item {_idx}] Showing {len(params.options)} options: {params.message}")
-
-                    loop = asyncio.get_running_loop()
-                    future = loop.create_future()
-                    _pending_inputs[_sid] = future
-
-                    event_queue.put_nowait({
-                        "type": "options",
-                        "content": {"message": params.message, "options": [o.model_dump() for o in params.options], "option_type": params.option_type},
-                        "session_id": _sid,
-                        "batch_item_index": _idx
-                    })
-
-                    result = await future
-                    try:
-                        selected_idx = int(result)
-                        if 0 <= selected_idx < len(params.options):
-                            selected = params.options[selected_idx]
-                            value = selected.value if selected.value else selected.label
-                            return ActionResult(extracted_content=f"USER SELECTED: {selected.label} (value: {value}). Proceed with this selection.")
-                    except (ValueError, IndexError):
-                        pass
-                    return ActionResult(extracted_content=f"User response: {result}")
-
-                # Step counter and callback
-                step_counter = 0
-
-                async def step_callback(state, output, step_idx, _idx=current_idx):
-                    nonlocal step_counter
-                    step_counter += 1
-
-                    if step_counter >= MAX_STEPS:
-                        logger.warning(f"[Batch Item {_idx}] Max steps ({MAX_STEPS}) reached.")
-                        await agent.stop(f"STOPPED: Maximum step limit ({MAX_STEPS}) reached.")
-                        return
-
-                    try:
-                        thought = output.current_state.thinking if output and output.current_state else "Processing..."
-                        event_queue.put_nowait({
-                            "type": "log",
-                            "content": f"[Item {_idx + 1}] Step {step_counter}/{MAX_STEPS}: {thought}"
-                        })
-                    except Exception as e:
-                        logger.warning(f"Error in step_callback: {e}")
-                        event_queue.put_nowait({
-                            "type": "log",
-                            "content": f"[Item {_idx + 1}] Step {step_counter}/{MAX_STEPS}: Processing..."
-                        })
-
-                agent = Agent(
-                    task=task,
-                    llm=llm,
-                    browser=browser,
-                    tools=local_tools,
-                    extend_system_message=extend_system_message,
-                    register_new_step_callback=step_callback,
-                    max_steps=MAX_STEPS,
-                    max_failures=3,
-                    max_actions_per_step=4,
-                    calculate_cost=True,  # Enable token/cost tracking
-                )
-
-                # Run agent for this item
-                item_result = None
-                item_error = None
-                item_usage = None
-
-                async def run_item_agent(_sid=current_session_id, _idx=current_idx):
-                    nonlocal item_result, item_error, item_usage
-                    try:
+                local_tools = build_tools(item_session_id, event_queue, idx=idx)
+
+                try:
+                    async with browser_pool.acquire() as browser:
+                        agent = Agent(
+                            task=task,
+                            llm=llm,
+                            browser=browser,
+                            tools=local_tools,
+                            extend_system_message=extend_system_message,
+                            register_new_step_callback=step_callback,
+                            max_steps=MAX_STEPS,
+                            max_failures=3,
+                            max_actions_per_step=4,
+                            calculate_cost=True,  # Enable token/cost tracking
+                        )
                         history = await agent.run()
-                        item_result = history.final_result()
-
-                        # Capture usage stats
-                        try:
-                            usage = history.usage
-                            if usage:
-                                item_usage = {
-                                    "input_tokens": usage.total_prompt_tokens,
-                                    "output_tokens": usage.total_completion_tokens,
-                                    "total_tokens": usage.total_tokens,
-                                    "total_cost": usage.total_cost,
-                                    "steps": step_counter
-                                }
-                                event_queue.put_nowait({
-                                    "type": "item_usage",
-                                    "content": item_usage,
-                                    "batch_item_index": _idx
-                                })
-                                logger.info(f"[Item {_idx}] Token usage - Input: {usage.total_prompt_tokens}, Output: {usage.total_completion_tokens}, Cost: ${usage.total_cost:.4f}")
-                        except Exception as usage_err:
-                            logger.warning(f"Could not get usage stats for item {_idx}: {usage_err}")
-                            event_queue.put_nowait({
-                                "type": "item_usage",
-                                "content": {"steps": step_counter},
-                                "batch_item_index": _idx
-                            })
-                    except Exception as e:
-                        item_error = str(e)
-                    finally:
-                        if _sid in _pending_inputs:
-                            future = _pending_inputs.pop(_sid)
-                            if not future.done():
-                                future.cancel()
-                        event_queue.put_nowait(None)
-
-                # Start agent task
-                asyncio.create_task(run_item_agent())
-
-                # Stream events for this item
-                while True:
-                    event = await event_queue.get()
-                    if event is None:
-                        break
-                    yield f"data: {json.dumps(event)}\n\n"
+                finally:
+                    _pending_inputs.cancel(item_session_id)
+                item_result = history.final_result()
+
+                # Capture usage stats
+                try:
+                    usage = history.usage
+                    if usage:
+                        # Accumulate usage stats
+                        total_batch_usage.input_tokens += usage.total_prompt_tokens
+                        total_batch_usage.output_tokens += usage.total_completion_tokens
+                        total_batch_usage.total_tokens += usage.total_tokens
+                        total_batch_usage.total_cost += usage.total_cost
+                        total_batch_usage.total_steps += step_counter
+                        await put_event({
+                            "type": "item_usage",
+                            "content": {
+                                "input_tokens": usage.total_prompt_tokens,
+                                "output_tokens": usage.total_completion_tokens,
+                                "total_tokens": usage.total_tokens,
+                                "total_cost": usage.total_cost,
+                                "steps": step_counter
+                            },
+                            "batch_item_index": idx
+                        })
+                        # Lazy %-formatting: nothing is formatted when INFO is filtered out
+                        logger.info("[Item %d] Token usage - Input: %d, Output: %d, Cost: $%.4f",
+                                    idx, usage.total_prompt_tokens, usage.total_completion_tokens, usage.total_cost)
+                except Exception as usage_err:
+                    logger.warning("Could not get usage stats for item %d: %s", idx, usage_err)
+                    await put_event({
+                        "type": "item_usage",
+                        "content": {"steps": step_counter},
+                        "batch_item_index": idx
+                    })
 
                 # Update result based on outcome
-                if item_error:
-                    results[idx].status = "failed"
-                    results[idx].error = item_error
-                    yield f"data: {json.dumps({'type': 'log', 'content': f'Item {idx + 1} FAILED: {item_error}'})}\n\n"
+                raw_result = str(item_result)
+                result_str = raw_result.casefold() if item_result else ""
+                # Check for failure indicators in the result message
+                if _FAILURE_RE.search(result_str):
+                    update_result(idx, status="failed", error=raw_result)
+                    if _OUT_OF_STOCK_RE.search(result_str):
+                        out_of_stock.add(OutOfStockCache.key(item))
+                    await put_event({'type': 'log', 'content': f'Item {idx + 1} FAILED: {raw_result}'})
                 else:
-                    result_str = str(item_result).lower() if item_result else ""
-                    # Check for failure indicators in the result message
-                    failure_indicators = [
-                        "out of stock", "sold out", "unavailable", "not available",
-                        "cannot be completed", "could not be placed", "cannot be placed",
-                        "order failed", "unable to order", "product unavailable",
-                        "currently unavailable", "no longer available"
-                    ]
-                    is_actual_failure = any(indicator in result_str for indicator in failure_indicators)
-
-                    if is_actual_failure:
-                        results[idx].status = "failed"
-                        results[idx].error = str(item_result)
-                        yield f"data: {json.dumps({'type': 'log', 'content': f'Item {idx + 1} FAILED: {item_result}'})}\n\n"
-                    else:
-                        results[idx].status = "success"
-                        results[idx].message = str(item_result)
-                        yield f"data: {json.dumps({'type': 'log', 'content': f'Item {idx + 1} completed successfully'})}\n\n"
-
-                # Accumulate usage stats
-                if item_usage:
-                    total_batch_usage["input_tokens"] += item_usage.get("input_tokens", 0)
-                    total_batch_usage["output_tokens"] += item_usage.get("output_tokens", 0)
-                    total_batch_usage["total_tokens"] += item_usage.get("total_tokens", 0)
-                    total_batch_usage["total_cost"] += item_usage.get("total_cost", 0)
-                    total_batch_usage["total_steps"] += item_usage.get("steps", 0)
-
-                # Send updated batch status
-                yield f"data: {json.dumps({'type': 'batch_status', 'content': [r.model_dump() for r in results]})}\n\n"
+                    update_result(idx, status="success", message=raw_result)
+                    if verbose:
+                        await put_event({'type': 'log', 'content': f'Item {idx + 1} completed successfully'})
 
             except Exception as e:
-                results[idx].status = "failed"
-                results[idx].error = str(e)
-                yield f"data: {json.dumps({'type': 'log', 'content': f'Item {idx + 1} FAILED: {str(e)}'})}\n\n"
-                yield f"data: {json.dumps({'type': 'batch_status', 'content': [r.model_dump() for r in results]})}\n\n"
+                update_result(idx, status="failed", error=str(e))
+                await put_event({'type': 'log', 'content': f'Item {idx + 1} FAILED: {str(e)}'})
+
+    # Items for the same SKU (product URL and color) run one after another, so a repeat can
+    # reuse an out-of-stock result. The cache belongs to this batch only; other users' batches never see it.
+    sku_locks: Dict[Tuple[str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+    out_of_stock = OutOfStockCache(OUT_OF_STOCK_TTL)
+
+    async def run_unique_item(idx: int, item: BatchOrderItem):
+        sku = OutOfStockCache.key(item)
+        async with sku_locks[sku]:
+            if sku in out_of_stock:
+                update_result(idx, status="failed", error="This product and color was reported unavailable moments ago; not retried")
+                await put_event({'type': 'log', 'content': f'Item {idx + 1} SKIPPED: same product and color was just reported unavailable'})
+                return
+            await run_item(idx, item)
+
+    async def run_all_items():
+        try:
+            async with asyncio.TaskGroup() as items_tg:
+                for idx, item in enumerate(request.items):
+                    items_tg.create_task(run_unique_item(idx, item))
+        finally:
+            # Send the last status update now rather than after the timer
+            if status_flush is not None:
+                status_flush.cancel()
+                flush_status()
+            event_queue.put_nowait(None)  # Sentinel
+
+    if concurrency > 1:
+        yield sse({'type': 'log', 'content': f'Running up to {concurrency} items at once'})
+
+    # Start the items
+    runner = asyncio.create_task(run_all_items())
+
+    try:
+        # Stream events from all items, a few at a time
+        async for chunk in drain(event_queue, linger=BATCH_FLUSH_INTERVAL):
+            yield chunk
+        await runner
 
         # Send final batch complete event
-        yield f"data: {json.dumps({'type': 'log', 'content': 'All items processed'})}\n\n"
-        success_count = sum(1 for r in results if r.status == "success")
-        failed_count = sum(1 for r in results if r.status == "failed")
+        yield sse({'type': 'log', 'content': 'All items processed'})
+        success_count = sum(1 for r in results if r["status"] == "success")
+        failed_count = sum(1 for r in results if r["status"] == "failed")
 
         # Send total usage stats for the batch
-        yield f"data: {json.dumps({'type': 'batch_usage', 'content': total_batch_usage})}\n\n"
+        yield sse({'type': 'batch_usage', 'content': total_batch_usage})
 
-        yield f"data: {json.dumps({'type': 'batch_complete', 'content': {'total': len(results), 'success': success_count, 'failed': failed_count, 'results': [r.model_dump() for r in results], 'usage': total_batch_usage}})}\n\n"
+        # Full status once more so the client ends in sync even if it missed a delta
+        yield sse({'type': 'batch_status', 'content': results})
+
+        yield sse({'type': 'batch_complete', 'content': {'total': len(results), 'success': success_count, 'failed': failed_count, 'results': results, 'usage': total_batch_usage}})
 
     finally:
-        # Close browser ONLY after ALL items are processed
-        try:
-            yield f"data: {json.dumps({'type': 'log', 'content': 'Closing browser after batch completion'})}\n\n"
-            await browser.kill()
-        except Exception as close_error:
-            logger.warning(f"Error closing browser: {close_error}")
+        # Client went away mid-batch: the task group cancels every running item
+        if not runner.done():
+            runner.cancel()
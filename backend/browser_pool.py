@@ -0,0 +1,220 @@
+"""
+Bounded pool of persistent browsers for concurrent agent sessions.
+Browsers are launched with keep_alive=True and handed out one session at a time,
+so concurrent sessions run in parallel without paying a Chromium cold start each.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from browser_use import Browser, BrowserProfile
+
+logger = logging.getLogger(__name__)
+
+# Persistent browser profile directory - stores cookies, login sessions, etc.
+BROWSER_PROFILE_DIR = Path(__file__).parent / "browser_profile"
+BROWSER_PROFILE_DIR.mkdir(exist_ok=True)
+
+# Pool configuration
+POOL_MIN_SIZE = int(os.getenv("BROWSER_POOL_MIN_SIZE", "1"))                      # Browsers kept warm
+POOL_MAX_SIZE = int(os.getenv("BROWSER_POOL_MAX_SIZE", "1"))                      # Max concurrent browsers
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("BROWSER_POOL_ACQUIRE_TIMEOUT", "300"))    # Seconds to wait for a free browser
+POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("BROWSER_POOL_HEALTH_CHECK_INTERVAL", "30"))
+POOL_IDLE_TIMEOUT = float(os.getenv("BROWSER_POOL_IDLE_TIMEOUT", "600"))          # Close idle browsers above min size
+POOL_PREWARM = os.getenv("BROWSER_POOL_PREWARM", "true").lower() == "true"        # Launch min size at startup
+
+# Browser launch settings, read once at import
+_HEADLESS = os.getenv("HEADLESS", "false").lower() == "true"
+_CHROME_ARGS = (
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+)
+
+
+def profile_dir_for_slot(slot: int) -> Path:
+    """
+    Chromium can only open a user_data_dir once, so every pooled browser needs its own.
+    Slot 0 uses the main profile so saved logins keep working.
+    """
+    if slot == 0:
+        return BROWSER_PROFILE_DIR
+    path = BROWSER_PROFILE_DIR.with_name(f"browser_profile_{slot}")
+    path.mkdir(exist_ok=True)
+    return path
+
+
+class BrowserPool:
+    """
+    Hands out keep_alive browsers, at most max_size at a time.
+    Idle browsers are health-checked in the background; dead ones are dropped and
+    browsers idle longer than idle_timeout are closed down to min_size.
+    """
+
+    def __init__(
+        self,
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        acquire_timeout: float = POOL_ACQUIRE_TIMEOUT,
+        health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL,
+        idle_timeout: float = POOL_IDLE_TIMEOUT,
+    ):
+        self.max_size = max(1, max_size)
+        self.min_size = max(0, min(min_size, self.max_size))
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.idle_timeout = idle_timeout
+
+        self._capacity = asyncio.Semaphore(self.max_size)
+        self._browsers: Dict[int, Browser] = {}       # slot -> browser
+        self._idle: List[Tuple[int, float]] = []       # (slot, idle_since), most recently used last
+        self._free_slots: List[int] = list(range(self.max_size))
+        self._maintenance_task: Optional[asyncio.Task] = None
+
+    async def start(self, prewarm: bool = POOL_PREWARM):
+        """Launch min_size browsers and start the background health check."""
+        if prewarm:
+            await self._top_up()
+        if self._maintenance_task is None:
+            self._maintenance_task = asyncio.create_task(self._maintain())
+
+    async def close(self):
+        """Stop the health check and kill every browser in the pool."""
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        self._idle.clear()
+        for slot in list(self._browsers):
+            await self._discard(slot)
+
+    async def checkout(self) -> Browser:
+        """Take a healthy browser from the pool, launching one if none are idle."""
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), timeout=self.acquire_timeout)
+        except TimeoutError:
+            # A bare TimeoutError has no message, which reaches users as an empty error
+            raise TimeoutError(
+                f"No browser free after {self.acquire_timeout:g}s "
+                f"(BROWSER_POOL_MAX_SIZE={self.max_size}, all in use)"
+            ) from None
+        try:
+            while self._idle:
+                slot, _ = self._idle.pop()
+                browser = self._browsers[slot]
+                if browser.is_cdp_connected:
+                    return browser
+                logger.warning(f"Pooled browser {slot} disconnected, replacing it")
+                await self._discard(slot)
+            # Holding a permit with nothing idle guarantees a free slot
+            return await self._launch(self._free_slots.pop(0))
+        except BaseException:
+            self._capacity.release()
+            raise
+
+    async def release(self, browser: Browser):
+        """Return a browser to the pool. Disconnected browsers are dropped."""
+        slot = self._slot_of(browser)
+        try:
+            if slot is None:
+                return
+            if browser.is_cdp_connected:
+                self._idle.append((slot, time.monotonic()))
+            else:
+                await self._discard(slot)
+        finally:
+            self._capacity.release()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """async with pool.acquire() as browser: ..."""
+        browser = await self.checkout()
+        try:
+            yield browser
+        finally:
+            await self.release(browser)
+
+    def _slot_of(self, browser: Browser) -> Optional[int]:
+        for slot, pooled in self._browsers.items():
+            if pooled is browser:
+                return slot
+        return None
+
+    async def _launch(self, slot: int) -> Browser:
+        browser = Browser(
+            browser_profile=BrowserProfile(
+                headless=_HEADLESS,
+                keep_alive=True,  # Prevents agents from closing pooled browsers
+                user_data_dir=str(profile_dir_for_slot(slot)),  # Persist cookies, login sessions
+                args=list(_CHROME_ARGS)
+            )
+        )
+        try:
+            await browser.start()
+        except BaseException:
+            self._free_slot(slot)
+            raise
+        self._browsers[slot] = browser
+        logger.info(f"Launched pooled browser {slot} ({len(self._browsers)}/{self.max_size})")
+        return browser
+
+    async def _discard(self, slot: int):
+        browser = self._browsers.pop(slot, None)
+        self._free_slot(slot)
+        if browser is None:
+            return
+        try:
+            await browser.kill()
+        except Exception as e:
+            logger.warning(f"Error closing pooled browser {slot}: {e}")
+
+    def _free_slot(self, slot: int):
+        if slot not in self._free_slots:
+            self._free_slots.append(slot)
+            self._free_slots.sort()
+
+    async def _top_up(self):
+        """Launch idle browsers until the pool holds min_size."""
+        while len(self._browsers) < self.min_size and not self._capacity.locked():
+            async with self._capacity:
+                slot = self._free_slots.pop(0)
+                try:
+                    await self._launch(slot)
+                except Exception as e:
+                    logger.warning(f"Could not pre-warm browser: {e}")
+                    return
+                self._idle.append((slot, time.monotonic()))
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self._check_idle()
+                await self._top_up()
+            except Exception as e:
+                logger.warning(f"Browser pool health check failed: {e}")
+
+    async def _check_idle(self):
+        now = time.monotonic()
+        keep, drop = [], []
+        for slot, idle_since in self._idle:
+            browser = self._browsers[slot]
+            if not browser.is_cdp_connected:
+                logger.warning(f"Pooled browser {slot} disconnected, dropping it")
+                drop.append(slot)
+            elif now - idle_since > self.idle_timeout and len(self._browsers) - len(drop) > self.min_size:
+                logger.info(f"Closing pooled browser {slot} after {now - idle_since:.0f}s idle")
+                drop.append(slot)
+            else:
+                keep.append((slot, idle_since))
+        self._idle = keep
+        for slot in drop:
+            await self._discard(slot)
+
+
+# Shared pool used by all agent sessions
+browser_pool = BrowserPool()
@@ -0,0 +1,55 @@
+"""
+LLM client setup for the agents.
+"""
+
+import functools
+from dataclasses import dataclass
+from typing import Optional
+
+from browser_use import ChatOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+LLM_MODEL = "gpt-4o"
+
+# browser_use builds a new AsyncOpenAI client for every completion; sharing one
+# HTTP client keeps the connection to the API open across agent steps and sessions
+_http_client = DefaultAsyncHttpxClient()
+
+
+@dataclass
+class PromptCachingChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI that tags every completion with a prompt_cache_key.
+    Requests sharing a key are routed to the same OpenAI prompt cache, so the large
+    static system prompt (sent first on every step) is served as cached prefill.
+    """
+
+    prompt_cache_key: Optional[str] = None
+
+    def get_client(self) -> AsyncOpenAI:
+        client = super().get_client()
+        if self.prompt_cache_key:
+            client.chat.completions.create = functools.partial(
+                client.chat.completions.create,
+                extra_body={"prompt_cache_key": self.prompt_cache_key},
+            )
+        return client
+
+
+def get_llm(temperature: float, cache_key: Optional[str] = None) -> ChatOpenAI:
+    """
+    Build the agent LLM.
+    cache_key should identify the static prompt prefix (e.g. "amazon:order") so
+    sessions with the same system prompt share a cache entry.
+    """
+    return PromptCachingChatOpenAI(
+        model=LLM_MODEL,
+        temperature=temperature,
+        prompt_cache_key=cache_key,
+        http_client=_http_client,
+    )
+
+
+async def close_llm_clients():
+    """Close the shared HTTP client. Called on app shutdown."""
+    await _http_client.aclose()
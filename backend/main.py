@@ -1,20 +1,48 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from schemas import AgentRequest, UserInputRequest, BatchOrderRequest
-from agent_controller import stream_agent_events, provide_input, stream_batch_order_events
+from agent_controller import stream_agent_events, stream_agent_websocket, provide_input, stream_batch_order_events
+from browser_pool import browser_pool
+from llm import close_llm_clients
+from streaming import ws_frame
 from dotenv import load_dotenv
+from pydantic import ValidationError
+import orjson
 
 load_dotenv()
 
 import asyncio
+import os
 import sys
 
+# uvloop (libuv event loop) speeds up the all-async LLM/CDP/SSE I/O path. Set UVLOOP=0 to use stock asyncio.
+USE_UVLOOP = sys.platform != 'win32' and os.getenv("UVLOOP", "1") == "1"
+
 # Force ProactorEventLoop on Windows to support subprocesses (required for Playwright/browser-use)
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+elif USE_UVLOOP:
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        USE_UVLOOP = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pre-warm pooled browsers so the first session skips the Chromium cold start
+    await browser_pool.start()
+    yield
+    await browser_pool.close()
+    await close_llm_clients()
+
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+# Keep proxies (nginx, etc.) from caching or buffering the event streams
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,9 +56,34 @@ app.add_middleware(
 async def stream_agent(request: AgentRequest):
     return StreamingResponse(
         stream_agent_events(request),
-        media_type="text/event-stream"
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
     )
 
+@app.websocket("/agent/ws")
+async def agent_websocket(websocket: WebSocket):
+    """
+    Same session as /agent/stream over one persistent socket.
+    The first message is the AgentRequest JSON. Events arrive as JSON arrays and
+    HITL answers are sent back as {"type": "input", "data": ...}.
+    """
+    await websocket.accept()
+    frame = await websocket.receive()
+    if frame["type"] == "websocket.disconnect":
+        return
+    # Text or binary, like the HITL input frames
+    try:
+        request = AgentRequest.model_validate(orjson.loads(frame.get("text") or frame.get("bytes") or b""))
+    except (orjson.JSONDecodeError, ValidationError) as e:
+        await websocket.send_bytes(ws_frame([{"type": "error", "content": str(e)}]))
+        await websocket.close(code=1003)
+        return
+    await stream_agent_websocket(request, websocket)
+    try:
+        await websocket.close()
+    except RuntimeError:
+        pass  # Client already closed the socket
+
 @app.post("/agent/input")
 async def receive_input(request: UserInputRequest):
     return await provide_input(request.session_id, request.input_data)
@@ -39,13 +92,14 @@ async def receive_input(request: UserInputRequest):
 async def batch_order(request: BatchOrderRequest):
     """
     Process multiple orders from CSV data.
-    Keeps browser alive and processes items sequentially.
+    Items run sequentially by default (BATCH_CONCURRENCY runs several at once).
     """
     return StreamingResponse(
         stream_batch_order_events(request),
-        media_type="text/event-stream"
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
     )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop" if USE_UVLOOP else "asyncio")
@@ -3,6 +3,8 @@ Prompts for Browser Use Agent - Amazon & Flipkart automation.
 Following Browser Use best practices: simple task + extend_system_message for instructions.
 """
 
+from functools import lru_cache
+
 # =============================================================================
 # EXTENDED SYSTEM MESSAGE (shared rules for all tasks)
 # =============================================================================
@@ -257,6 +259,59 @@ STEP 6 - VERIFY SUCCESS:
 """
 
 
+# Full system messages, concatenated once at import
+_EXTEND_SYSTEM_MESSAGES = {
+    ("amazon", "search"): BASE_EXTEND_SYSTEM_MESSAGE + AMAZON_SEARCH_EXTEND,
+    ("amazon", "order"): BASE_EXTEND_SYSTEM_MESSAGE + AMAZON_ORDER_EXTEND,
+    ("flipkart", "search"): BASE_EXTEND_SYSTEM_MESSAGE + FLIPKART_SEARCH_EXTEND,
+    ("flipkart", "order"): BASE_EXTEND_SYSTEM_MESSAGE + FLIPKART_ORDER_EXTEND,
+}
+
+
+def get_extend_system_message(platform: str, action: str) -> str:
+    """
+    Get the extend_system_message for a platform/action.
+    Depends on nothing else, so batches can build it once for all items.
+    """
+    try:
+        return _EXTEND_SYSTEM_MESSAGES[(platform, action)]
+    except KeyError:
+        raise ValueError(f"Unknown platform/action combination: {platform}/{action}") from None
+
+
+def get_order_task(platform: str, product_url: str, additional_instructions: str = None,
+                   quantity: int = 1, color: str = None) -> str:
+    """
+    Get the order task for one product, with quantity, color, and additional instructions.
+    """
+    if not product_url:
+        raise ValueError("product_url is required for order action")
+    template = AMAZON_ORDER_TASK if platform == "amazon" else FLIPKART_ORDER_TASK
+
+    # Task plus user instructions (quantity, color, additional), joined in one pass
+    parts = [template.format(product_url=product_url), "\n\nUSER INSTRUCTIONS:\nQuantity: ", str(quantity)]
+    if color:
+        parts += ("\nColor/Variant: ", color, " (select this color/variant on the product page)")
+    if additional_instructions:
+        parts += ("\nAdditional: ", additional_instructions)
+    return "".join(parts)
+
+
+@lru_cache(maxsize=128)
+def _build_prompt(platform: str, action: str, product_url: str, query: str,
+                  additional_instructions: str, quantity: int, color: str) -> tuple:
+    # Prompts are pure functions of their arguments, so repeated requests reuse the built strings
+    extend_system_message = get_extend_system_message(platform, action)
+
+    if action == "search":
+        template = AMAZON_SEARCH_TASK if platform == "amazon" else FLIPKART_SEARCH_TASK
+        task = template.format(query=query or "")
+    else:
+        task = get_order_task(platform, product_url, additional_instructions, quantity, color)
+
+    return task, extend_system_message
+
+
 def get_prompt(platform: str, action: str, product_url: str = None, query: str = None,
                additional_instructions: str = None, quantity: int = 1, color: str = None) -> dict:
     """
@@ -265,57 +320,10 @@ def get_prompt(platform: str, action: str, product_url: str = None, query: str =
     Returns:
         dict with 'task' and 'extend_system_message' keys
     """
-    base_extend = BASE_EXTEND_SYSTEM_MESSAGE
-
-    if platform == "amazon" and action == "search":
-        return {
-            "task": AMAZON_SEARCH_TASK.format(query=query or ""),
-            "extend_system_message": base_extend + AMAZON_SEARCH_EXTEND
-        }
-
-    elif platform == "amazon" and action == "order":
-        if not product_url:
-            raise ValueError("product_url is required for order action")
-        task = AMAZON_ORDER_TASK.format(product_url=product_url)
-
-        # Build user instructions with quantity, color, and additional instructions
-        user_instructions_parts = []
-        user_instructions_parts.append(f"Quantity: {quantity}")
-        if color:
-            user_instructions_parts.append(f"Color/Variant: {color} (select this color/variant on the product page)")
-        if additional_instructions:
-            user_instructions_parts.append(f"Additional: {additional_instructions}")
-
-        task += f"\n\nUSER INSTRUCTIONS:\n" + "\n".join(user_instructions_parts)
-        return {
-            "task": task,
-            "extend_system_message": base_extend + AMAZON_ORDER_EXTEND
-        }
-
-    elif platform == "flipkart" and action == "search":
-        return {
-            "task": FLIPKART_SEARCH_TASK.format(query=query or ""),
-            "extend_system_message": base_extend + FLIPKART_SEARCH_EXTEND
-        }
-
-    elif platform == "flipkart" and action == "order":
-        if not product_url:
-            raise ValueError("product_url is required for order action")
-        task = FLIPKART_ORDER_TASK.format(product_url=product_url)
-
-        # Build user instructions with quantity, color, and additional instructions
-        user_instructions_parts = []
-        user_instructions_parts.append(f"Quantity: {quantity}")
-        if color:
-            user_instructions_parts.append(f"Color/Variant: {color} (select this color/variant on the product page)")
-        if additional_instructions:
-            user_instructions_parts.append(f"Additional: {additional_instructions}")
-
-        task += f"\n\nUSER INSTRUCTIONS:\n" + "\n".join(user_instructions_parts)
-        return {
-            "task": task,
-            "extend_system_message": base_extend + FLIPKART_ORDER_EXTEND
-        }
-
-    else:
-        raise ValueError(f"Unknown platform/action combination: {platform}/{action}")
+    task, extend_system_message = _build_prompt(
+        platform, action, product_url, query, additional_instructions, quantity, color
+    )
+    return {
+        "task": task,
+        "extend_system_message": extend_system_message
+    }
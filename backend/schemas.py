@@ -22,6 +22,8 @@ class BatchOrderRequest(BaseModel):
     additional_instructions: Optional[str] = None
     session_id: Optional[str] = None
     temperature: Optional[float] = None
+    max_concurrency: Optional[int] = None  # Items run at once (defaults to BATCH_CONCURRENCY, capped by pool size)
+    log_level: Literal["verbose", "summary"] = "summary"  # "summary" skips per-step and per-item progress logs
 
 class UserInputRequest(BaseModel):
     session_id: str
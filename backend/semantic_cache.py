@@ -0,0 +1,85 @@
+"""
+Semantic cache for search results.
+Near-identical search queries ("red running shoes under 3000") are matched by
+embedding similarity and served the cached product list without running an agent.
+Only search results are cached - orders have side effects and always run the agent.
+"""
+
+import logging
+import operator
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))   # Min cosine similarity for a hit
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "600"))               # Seconds before prices go stale
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "256"))  # Per platform
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+class SemanticCache:
+    """
+    In-process embedding cache, one namespace per platform.
+    OpenAI embeddings are unit length, so cosine similarity is a plain dot product.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: float = SEMANTIC_CACHE_TTL,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        enabled: bool = SEMANTIC_CACHE_ENABLED,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # platform -> [(embedding, value, expires_at)], oldest first
+        self._entries: Dict[str, List[Tuple[List[float], Any, float]]] = {}
+        self._client: Optional[AsyncOpenAI] = None
+
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """Embed a query. Returns None if the cache is disabled or the embedding call fails."""
+        if not self.enabled:
+            return None
+        if self._client is None:
+            self._client = AsyncOpenAI()
+        try:
+            response = await self._client.embeddings.create(model=EMBEDDING_MODEL, input=text.strip().lower())
+        except Exception as e:
+            logger.warning(f"Semantic cache embedding failed: {e}")
+            return None
+        return response.data[0].embedding
+
+    def lookup(self, platform: str, embedding: Optional[List[float]]) -> Optional[Any]:
+        """Return the cached value most similar to embedding, if it clears the threshold."""
+        if embedding is None:
+            return None
+        now = time.monotonic()
+        best_score, best_value = self.threshold, None
+        for cached, value, expires_at in self._entries.get(platform, ()):
+            if expires_at < now:
+                continue
+            score = sum(map(operator.mul, embedding, cached))
+            if score >= best_score:
+                best_score, best_value = score, value
+        if best_value is not None:
+            logger.info(f"Semantic cache hit on {platform} (similarity {best_score:.3f})")
+        return best_value
+
+    def store(self, platform: str, embedding: Optional[List[float]], value: Any):
+        if embedding is None:
+            return
+        now = time.monotonic()
+        entries = [e for e in self._entries.get(platform, ()) if e[2] >= now]
+        entries.append((embedding, value, now + self.ttl))
+        self._entries[platform] = entries[-self.max_entries:]
+
+
+# Shared cache for search sessions
+search_cache = SemanticCache()
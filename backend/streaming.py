@@ -0,0 +1,149 @@
+"""
+Event streaming helpers shared by the SSE and WebSocket endpoints.
+"""
+
+import asyncio
+from collections import deque
+from typing import Any, AsyncGenerator, List, Optional
+
+import orjson
+from pydantic import BaseModel
+
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
+
+class EventQueue:
+    """
+    Event queue for one consumer (the SSE generator).
+    Producers (tools, step callbacks, the agent task) run on the same event loop and
+    append to a deque; the consumer parks on a single future while the queue is empty.
+    Drop-in for the asyncio.Queue methods used here, without its locks and getter lists.
+
+    With maxsize set, async producers that await put() wait for the consumer once
+    maxsize events are pending, so a slow client throttles them instead of growing the
+    queue. put_nowait() never blocks - sync callbacks and the sentinel always get through.
+    """
+
+    __slots__ = ("_items", "_waiter", "_maxsize", "_putters")
+
+    def __init__(self, maxsize: int = 0):
+        self._items: deque = deque()
+        self._waiter: Optional[asyncio.Future] = None
+        self._maxsize = maxsize
+        self._putters: deque = deque()   # Futures of producers waiting for room
+
+    def put_nowait(self, item: Any):
+        self._items.append(item)
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def put(self, item: Any):
+        """Append item, first waiting for room if maxsize events are pending."""
+        while self.full():
+            putter = asyncio.get_running_loop().create_future()
+            self._putters.append(putter)
+            await putter
+        self.put_nowait(item)
+
+    def full(self) -> bool:
+        return 0 < self._maxsize <= len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def get_nowait(self) -> Any:
+        if not self._items:
+            raise asyncio.QueueEmpty
+        item = self._items.popleft()
+        putters = self._putters
+        while putters:
+            putter = putters.popleft()
+            if not putter.done():   # Skip producers that were cancelled while waiting
+                putter.set_result(None)
+                break
+        return item
+
+    async def get(self) -> Any:
+        while not self._items:
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+        return self.get_nowait()
+
+
+def _default(obj):
+    # Pydantic models in event payloads are dumped lazily by orjson
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError
+
+
+def sse(event) -> bytes:
+    """Encode one event as an SSE frame."""
+    return _SSE_PREFIX + orjson.dumps(event, default=_default) + _SSE_SUFFIX
+
+
+def ws_frame(events: List[Any]) -> bytes:
+    """Encode a burst of events as one WebSocket message (a JSON array)."""
+    return orjson.dumps(events, default=_default)
+
+
+async def drain_batches(event_queue) -> AsyncGenerator[List[Any], None]:
+    """
+    Yield lists of events from event_queue until the None sentinel.
+    Events that are already queued when one arrives are returned together,
+    so bursts cost one write instead of one per event.
+    """
+    while True:
+        event = await event_queue.get()
+        if event is None:
+            return
+        batch = [event]
+        while not event_queue.empty():
+            event = event_queue.get_nowait()
+            if event is None:
+                yield batch
+                return
+            batch.append(event)
+        yield batch
+
+
+async def drain(event_queue, linger: float = 0.0, max_bytes: int = 8192) -> AsyncGenerator[bytes, None]:
+    """
+    Yield SSE chunks from event_queue until the None sentinel, one chunk per burst.
+    With linger set, a chunk also waits up to linger seconds for more events (or until
+    it reaches max_bytes), trading that much latency for fewer, larger writes.
+    """
+    if not linger:
+        async for batch in drain_batches(event_queue):
+            yield b"".join(map(sse, batch))
+        return
+
+    loop = asyncio.get_running_loop()
+    buf = bytearray()
+    while True:
+        event = await event_queue.get()
+        if event is None:
+            return
+        buf += sse(event)
+        deadline = loop.time() + linger
+        while len(buf) < max_bytes:
+            if event_queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(event_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                event = event_queue.get_nowait()
+            if event is None:
+                yield bytes(buf)
+                return
+            buf += sse(event)
+        yield bytes(buf)
+        buf.clear()
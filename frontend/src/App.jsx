@@ -53,13 +53,16 @@ function App() {
 
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
+      // SSE frames can be split across reads; keep the unfinished tail for the next one
+      let buffer = '';
 
       while (true) {
         const { value, done } = await reader.read();
         if (done) break;
 
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n\n');
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n\n');
+        buffer = lines.pop();
 
         for (const line of lines) {
           if (line.startsWith('data: ')) {
@@ -101,13 +104,16 @@ function App() {
 
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
+      // SSE frames can be split across reads; keep the unfinished tail for the next one
+      let buffer = '';
 
       while (true) {
         const { value, done } = await reader.read();
         if (done) break;
 
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n\n');
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n\n');
+        buffer = lines.pop();
 
         for (const line of lines) {
           if (line.startsWith('data: ')) {
@@ -152,6 +158,15 @@ function App() {
     } else if (event.type === 'batch_status') {
       // Update batch status
       setBatchStatus(event.content);
+    } else if (event.type === 'batch_status_delta') {
+      // Patch only the rows that changed
+      setBatchStatus(prev => {
+        const next = [...prev];
+        for (const row of event.content) {
+          next[row.index] = row;
+        }
+        return next;
+      });
     } else if (event.type === 'batch_complete') {
       // Batch order completed
       const result = event.content;